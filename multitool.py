@@ -1,340 +1,1009 @@
-import subprocess
-import sys
+import atexit
+import contextlib
+import errno
+import functools
+import itertools
 import os
+import queue
+import selectors
+import struct
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import ndef
+    import nfc
+    import nfc.clf.device
+    import nfc.clf.pn53x
+    import nfc.clf.transport
+    import nfc.tag
+except ImportError as e:
+    # Reported with an install hint by the entry points, not at import
+    _IMPORT_ERROR = e
+else:
+    _IMPORT_ERROR = None
+
+# SAK (SEL_RES) values of the MIFARE Classic family
+MIFARE_CLASSIC_SAK = {
+    0x08: "MIFARE Classic 1K",
+    0x88: "MIFARE Classic 1K",
+    0x09: "MIFARE Classic Mini",
+    0x18: "MIFARE Classic 4K",
+}
+
+
+class CardError(Exception):
+    """The card refused a command or stopped answering, the reader is fine"""
+
+
+class UnsupportedTag(Exception):
+    """The tag was found but this tool can't work with its type"""
+
+
+# Factory default MIFARE Classic keys, tried in order
+_DEFAULT_KEYS = (
+    b'\xff' * 6,
+    bytes.fromhex('a0a1a2a3a4a5'),
+    bytes.fromhex('d3f7d3f7d3f7'),
+)
+
+# Block 0 scratch buffer, only the worker thread touches it (under
+# _clf_lock)
+_BLOCK0 = bytearray(16)
+
+
+def _crca_table():
+    """Lookup table for CRC_A (x^16 + x^12 + x^5 + 1, reflected)"""
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRCA_TABLE = _crca_table()
+
+# Raw frame timeouts: the chip gives up after 100 us * 2**(n-1), the
+# host waits longer so a missing answer is always the chip's error
+_RAW_RF_TIMEOUT = 0x09  # 25.6 ms
+_RAW_TIMEOUT = 0.1
+
+_SEP = "=" * 50
+
+# Fixed screens, each written to the terminal in one go
+_HEADER = (
+    f"\n{_SEP}\n"
+    "NFC Tag Manager - ACR122U\n"
+    f"{_SEP}\n"
+    "\nIMPORTANT:\n"
+    "• Option 4 only works with CHINESE CLONE Mifare 1K cards\n"
+    f"{_SEP}\n\n"
+)
+
+_MENU = (
+    "\nOptions:\n"
+    "  0. List NFC readers\n"
+    "  1. Read NFC tag\n"
+    "  2. Identify card type\n"
+    "  3. Diagnose card (UID write capability)\n"
+    "  4. Write serial number to tag (UID - clones only)\n"
+    "  5. Write text to tag (NDEF - NTAG/Ultralight)\n"
+    "  6. Batch write text from file (NDEF)\n"
+    "  7. Exit\n"
+)
+
+_READ_HEADER = (
+    "NFC Tag Reader - ACR122U\n"
+    f"{_SEP}\n"
+    "Place NFC tag on reader...\n\n"
+)
+
+_DIAGNOSE_HEADER = (
+    "Diagnosing card...\n\n"
+    "Checking UID write requirements...\n"
+    "→ UID writes ONLY work with Chinese clone Mifare Classic 1K cards\n"
+    "→ Most commercial/genuine cards are NOT compatible\n\n"
+)
+
+_VENDOR_HEADER = (
+    "Card vendor detection:\n"
+    "  Chinese clones → UID write will work\n"
+    "  Genuine/commercial → use alternative method\n\n"
+)
+
+_LIST_HEADER = f"Available NFC Devices:\n{_SEP}\n\n"
+
+# NFC_DEBUG=1 adds a traceback to unexpected errors
+_DEBUG = bool(os.environ.get('NFC_DEBUG'))
+
+# Seconds to wait for a tag before giving up
+TAG_TIMEOUT = 5.0
+
+# Pause between single polls while waiting for a tag, the last value
+# repeats: a tag that is already there is seen within a few ms, a
+# long wait settles at five polls a second
+TAG_POLL_BACKOFF = (0.01, 0.02, 0.05, 0.1, 0.2)
+
+# Seconds a detected tag is reused by the next menu action
+TAG_CACHE_TTL = 3.0
+
+# Last detected tag, so diagnose -> write doesn't poll the card again
+_tag_cache = {'target': None, 'tag': None, 'ts': 0.0}
+
+# Serialises access to the reader between menu actions
+_clf_lock = threading.Lock()
+
+# Reader, opened by the first NFC action rather than at startup
+_clf = None
+
+# Set from the menu thread to abort a running tag poll
+_cancel = threading.Event()
+
+
+def _connect(clf, timeout=TAG_TIMEOUT):
+    """Wait up to timeout seconds for a tag, return (target, tag)"""
+    deadline = time.time() + timeout
+    pauses = itertools.chain(
+        TAG_POLL_BACKOFF, itertools.repeat(TAG_POLL_BACKOFF[-1])
+    )
+
+    for pause in pauses:
+        target = clf.sense(nfc.clf.RemoteTarget('106A'))
+        if target is not None:
+            break
+
+        remaining = deadline - time.time()
+        if remaining <= 0 or _cancel.wait(min(pause, remaining)):
+            return None, None
+
+    # Type 1 (Topaz) answers RID instead of anticollision, so there's
+    # no UID or SAK for the rest of the tool to go on
+    if target.sel_res is None:
+        raise UnsupportedTag("Type 1 (Topaz) tag, not supported")
+
+    # nfcpy has no MIFARE Classic support, don't try to activate
+    if target.sel_res[0] in MIFARE_CLASSIC_SAK:
+        return target, None
+    return target, nfc.tag.activate(clf, target)
+
+
+def _is_present(clf, target, tag):
+    """Check that a previously detected tag is still on the reader"""
+    if tag is not None:
+        try:
+            return tag.is_present
+        except nfc.clf.CommunicationError:
+            return False
+    # No nfcpy tag object (MIFARE Classic), select the same UID again
+    return clf.sense(
+        nfc.clf.RemoteTarget('106A', sel_req=target.sdd_res)
+    ) is not None
+
+
+def _get_tag(clf, timeout=TAG_TIMEOUT):
+    """Return (target, tag), reusing the cached tag if still present"""
+    target, tag = _tag_cache['target'], _tag_cache['tag']
+    fresh = time.time() - _tag_cache['ts'] < TAG_CACHE_TTL
+
+    if target is None or not fresh or not _is_present(clf, target, tag):
+        target, tag = _connect(clf, timeout)
+
+    _tag_cache.update(target=target, tag=tag, ts=time.time())
+    return target, tag
+
+
+def dependencies_missing():
+    """Print what to install if nfcpy couldn't be imported, True if so"""
+    if _IMPORT_ERROR is None:
+        return False
+    # The missing module may be one of nfcpy's own dependencies
+    print(f"✗ Could not import nfcpy: {_IMPORT_ERROR}")
+    print("Install: pip install nfcpy")
+    return True
+
+
+def _forget_tag():
+    """Drop the cached tag, e.g. after a reader error"""
+    _tag_cache.update(target=None, tag=None, ts=0.0)
+
+
+def _reader_lost():
+    """Drop the cached tag, reader list and frontend after a reader error
+
+    Only called from NFC operations, i.e. on the worker under _clf_lock.
+    The next action scans the bus and opens the reader again.
+    """
+    global _clf
+    _forget_tag()
+    _enumerate_devices.cache_clear()
+    if _clf is not None:
+        # The device may already be gone, closing it can fail any way
+        with contextlib.suppress(Exception):
+            _clf.close()
+        _clf = None
+
+
+@functools.lru_cache(maxsize=1)
+def _enumerate_devices():
+    """Supported USB readers as (path, vid, pid, driver), enumerated once"""
+    found = nfc.clf.transport.USB.find('usb') or []
+    return tuple(
+        (f"usb:{bus:03d}:{dev:03d}", vid, pid,
+         nfc.clf.device.usb_device_map[(vid, pid)])
+        for vid, pid, bus, dev in found
+        if (vid, pid) in nfc.clf.device.usb_device_map
+    )
+
 
+def _write(text):
+    """Write a block of text to stdout with a single flush"""
+    sys.stdout.write(text)
+    sys.stdout.flush()
 
-def read_nfc_tag():
-    """Read NFC tag using libnfc (nfc-poll)"""
-    print("NFC Tag Reader - ACR122U")
-    print("=" * 50)
-    print("Place NFC tag on reader (and remove after approx 5sec to continue)...\n")
+
+def _debug_trace():
+    """Print the current exception's traceback when NFC_DEBUG is set"""
+    if _DEBUG:
+        traceback.print_exc()
+
+
+def _bcc(uid4):
+    """Block check character of a 4 byte UID"""
+    return uid4[0] ^ uid4[1] ^ uid4[2] ^ uid4[3]
+
+
+def _build_block0(uid4, tail):
+    """Block 0 for a 4 byte UID: UID, BCC and the card's own 11 byte tail"""
+    struct.pack_into('4sB11s', _BLOCK0, 0, uid4, _bcc(uid4), tail)
+    return bytes(_BLOCK0)
+
+
+def _crc_a(data):
+    """ISO/IEC 14443-3 CRC_A of data, low byte first"""
+    crc = 0x6363
+    for b in data:
+        crc = (crc >> 8) ^ _CRCA_TABLE[(crc ^ b) & 0xFF]
+    return bytes((crc & 0xFF, crc >> 8))
+
+
+def _raw_exchange(chipset, data, bits=8, timeout=_RAW_TIMEOUT):
+    """Send a raw frame, bits is the number of bits in the last byte"""
+    chipset.write_register("CIU_BitFraming", bits & 0x07)
+    try:
+        return chipset.in_communicate_thru(data, timeout)
+    except IOError as e:
+        if e.errno != errno.ETIMEDOUT:
+            raise
+        # The host gave up first, still just no answer from the card
+        raise CardError("no answer from card") from e
+
+
+def _is_ack(rsp):
+    """MIFARE 4 bit ACK"""
+    return bool(rsp) and rsp[0] & 0x0F == 0x0A
+
+
+@contextlib.contextmanager
+def _raw_mode(chipset):
+    """Switch off the chip's CRC handling for hand-built frames"""
+    # nfcpy sets the InCommunicateThru timeout per exchange, whatever
+    # the last one left behind may be longer than our host timeout
+    chipset.rf_configuration(0x02, bytes([0x00, 0x0B, _RAW_RF_TIMEOUT]))
+
+    tx_mode, rx_mode = chipset.read_register("CIU_TxMode", "CIU_RxMode")
+    chipset.write_register(
+        ("CIU_TxMode", tx_mode & 0x7F),
+        ("CIU_RxMode", rx_mode & 0x7F)
+    )
 
     try:
-        result = subprocess.run(
-            ['nfc-poll'],
-            capture_output=True,
-            text=True,
-            timeout=60
+        yield
+    finally:
+        chipset.write_register(
+            ("CIU_BitFraming", 0x00),
+            ("CIU_TxMode", tx_mode),
+            ("CIU_RxMode", rx_mode)
         )
 
-        if result.stdout:
-            print(result.stdout)
 
-        if "ISO/IEC 14443A" in result.stdout:
-            print("✓ Tag read successfully!")
+def _magic_unlock(chipset):
+    """HALT the card and open the gen1a clone backdoor, False if none"""
+    # Same frames nfc-mfsetuid sends: HALT and the 7 bit 0x40 / 0x43
+    # unlock, with CRC_A added here since _raw_mode switches it off
+    halt = b'\x50\x00'
+    try:
+        _raw_exchange(chipset, halt + _crc_a(halt))
+    except (nfc.clf.pn53x.Chipset.Error, CardError):
+        pass  # HALT is never answered
+
+    try:
+        return (
+            _is_ack(_raw_exchange(chipset, b'\x40', bits=7))
+            and _is_ack(_raw_exchange(chipset, b'\x43'))
+        )
+    except (nfc.clf.pn53x.Chipset.Error, CardError):
+        return False
+
+
+def _magic_write_block0(clf, uid4):
+    """Write a UID through the gen1a clone backdoor, False if no backdoor"""
+    chipset = clf.device.chipset
+    with _raw_mode(chipset):
+        if not _magic_unlock(chipset):
+            return False
+
+        # The unlocked card reads without authentication. Keep its own
+        # SAK, ATQA and manufacturer bytes, so a 4K or Mini clone
+        # doesn't start to announce itself as a 1K
+        read = b'\x30\x00'
+        rsp = bytes(_raw_exchange(chipset, read + _crc_a(read)))
+        if len(rsp) != 18 or _crc_a(rsp[:16]) != rsp[16:]:
+            raise CardError("block 0 could not be read")
+        block0 = _build_block0(uid4, rsp[5:16])
+
+        write = b'\xA0\x00'
+        if not _is_ack(_raw_exchange(chipset, write + _crc_a(write))):
+            raise CardError("block 0 write not acknowledged")
+        if not _is_ack(_raw_exchange(chipset, block0 + _crc_a(block0))):
+            raise CardError("block 0 data not acknowledged")
+        return True
+
+
+def _is_gen1a(clf, target):
+    """Probe the gen1a backdoor without writing anything"""
+    with _raw_mode(clf.device.chipset):
+        unlocked = _magic_unlock(clf.device.chipset)
+
+    # The probe leaves the card halted, select it again
+    if clf.sense(
+        nfc.clf.RemoteTarget('106A', sel_req=target.sdd_res)
+    ) is None:
+        raise CardError("card not responding after backdoor probe")
+    return unlocked
+
+
+def _authenticate(clf, target, block, key, key_type=0x60):
+    """MIFARE Classic authentication with key A (0x60) or B (0x61)"""
+    # The chip firmware runs Crypto1 for InDataExchange, it needs the
+    # receive CRC check nfcpy turns off when sensing SAK 08 cards
+    chipset = clf.device.chipset
+    rx_mode = chipset.read_register("CIU_RxMode")
+    chipset.write_register("CIU_RxMode", rx_mode | 0x80)
+
+    uid = bytes(target.sdd_res[-4:])
+    try:
+        chipset.in_data_exchange(bytes([key_type, block]) + key + uid, 0.1)
+        return True
+    except nfc.clf.pn53x.Chipset.Error as e:
+        if e.errno != 0x14:  # not an authentication error
+            raise
+        # A failed authentication halts the card, select it again
+        clf.sense(nfc.clf.RemoteTarget('106A', sel_req=target.sdd_res))
+        return False
+
+
+def _read_block(clf, block):
+    """Read a 16 byte block of an authenticated MIFARE Classic sector"""
+    return clf.device.chipset.in_data_exchange(bytes([0x30, block]), 0.1)[0]
+
+
+def _print_target(target):
+    """Print target details in the same layout as nfc-poll"""
+    _write(
+        "ISO/IEC 14443A (106 kbps) target:\n"
+        f"    ATQA (SENS_RES): {target.sens_res.hex(' ')}\n"
+        f"       UID (NFCID1): {target.sdd_res.hex(' ')}\n"
+        f"      SAK (SEL_RES): {target.sel_res.hex(' ')}\n"
+    )
+
+
+def read_nfc_tag(clf, timeout=TAG_TIMEOUT):
+    """Read NFC tag using nfcpy"""
+    _write(_READ_HEADER)
+
+    try:
+        target, tag = _get_tag(clf, timeout)
+
+        if target is not None:
+            _print_target(target)
+            if tag is not None:
+                print(f"\n{tag}")
+            print("\n✓ Tag read successfully!")
             return True
         else:
-            print("✗ No tag detected")
+            print("✗ Timeout - no tag detected")
             return False
 
-    except FileNotFoundError:
-        print("✗ nfc-poll not installed")
-        print("Install: sudo apt-get install libnfc-bin")
-        return False
-    except subprocess.TimeoutExpired:
-        print("✗ Timeout - no tag detected")
+    except IOError as e:
+        _reader_lost()
+        print(f"✗ Reader error: {e}")
         return False
     except Exception as e:
         print(f"✗ Error: {e}")
+        _debug_trace()
         return False
 
 
-def identify_card_type():
+def identify_card_type(clf, timeout=TAG_TIMEOUT):
     """Identify the NFC card type"""
     print("Identifying card type...")
-    print("Place NFC tag on reader (and remove after approx 5sec to continue)...\n")
+    print("Place NFC tag on reader...\n")
 
     try:
-        result = subprocess.run(
-            ['nfc-poll', '-v'],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
+        target, tag = _get_tag(clf, timeout)
+
+        if target is None:
+            print("✗ Timeout - no tag detected")
+            return None
 
-        output = result.stdout + result.stderr
+        sak = target.sel_res[0]
 
-        if "MIFARE Classic" in output:
-            print("Card Type: MIFARE Classic 1K (should support UID write)")
+        if sak in MIFARE_CLASSIC_SAK:
+            print(
+                f"Card Type: {MIFARE_CLASSIC_SAK[sak]} "
+                "(should support UID write)"
+            )
             card_type = "mifare_classic"
-        elif "Mifare Ultralight" in output:
-            print("Card Type: Mifare Ultralight (limited write)")
-            card_type = "mifare_ultralight"
-        elif "NTAG" in output:
-            print("Card Type: NTAG (use NDEF for text)")
-            card_type = "ntag"
-        elif "ISO/IEC 14443A" in output:
+        elif tag is not None and tag.type == "Type2Tag":
+            # Ultralight and NTAG share SAK 00, nfcpy tells them
+            # apart by GET_VERSION during activation
+            if "NTAG" in tag.product:
+                print("Card Type: NTAG (use NDEF for text)")
+                card_type = "ntag"
+            else:
+                print("Card Type: Mifare Ultralight (limited write)")
+                card_type = "mifare_ultralight"
+        else:
             print("Card Type: ISO14443A (generic)")
-            print("\nFull output:")
-            print(output)
+            print("\nTarget:")
+            _print_target(target)
             card_type = "iso14443a"
-        else:
-            print("Card Type: Unknown")
-            print("\nFull output:")
-            print(output)
-            card_type = "unknown"
 
         return card_type
 
-    except FileNotFoundError:
-        print("✗ nfc-poll not installed")
-        return None
-    except subprocess.TimeoutExpired:
-        print("✗ Timeout - no tag detected")
+    except IOError as e:
+        _reader_lost()
+        print(f"✗ Reader error: {e}")
         return None
     except Exception as e:
         print(f"Error identifying card: {e}")
+        _debug_trace()
         return None
 
 
-def diagnose_card():
+def diagnose_card(clf):
     """Diagnose card write capability"""
-    print("Diagnosing card...\n")
+    _write(_DIAGNOSE_HEADER)
 
-    print("Checking nfc-mfsetuid requirements...")
-    print(
-        "→ nfc-mfsetuid ONLY works with Chinese clone "
-        "Mifare Classic 1K cards"
-    )
-    print("→ Most commercial/genuine cards are NOT compatible\n")
+    try:
+        target, _ = _get_tag(clf)
 
-    # Try to read the card
-    print("Attempting to read card with nfc-mfclassic...\n")
+        if target is None:
+            print("✗ Timeout - no tag detected")
+            return False
 
-    try:
-        # Create a temp file for the dump
-        temp_dump = "/tmp/nfc_test.mfd"
-
-        result = subprocess.run(
-            ['nfc-mfclassic', 'r', 'a', 'u', temp_dump],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
+        if target.sel_res[0] not in MIFARE_CLASSIC_SAK:
+            print("✗ Not a MIFARE Classic card")
+            print("→ UID cannot be rewritten\n")
+            return False
 
-        output = result.stdout + result.stderr
+        print("Trying default keys on sector 0...\n")
 
-        # Clean up temp file
-        if os.path.exists(temp_dump):
-            os.remove(temp_dump)
+        key = next(
+            (k for k in _DEFAULT_KEYS if _authenticate(clf, target, 0, k)),
+            None
+        )
 
-        if result.returncode == 0:
-            print("✓ Successfully read card")
-            print("→ Card is readable (default keys work)")
+        if key is not None:
+            print("✓ Successfully authenticated sector 0")
+            print(f"→ Card is readable (default key {key.hex().upper()})")
             print("→ Card MAY be writable\n")
 
-            # Try to test write capability
+            # Dump sector 0 straight from the card, block 0 holds the UID
+            print("Sector 0:")
+            for block in range(4):
+                print(f"  {block}: {_read_block(clf, block).hex(' ')}")
+            print()
+
+            # The card is now in sector 0's Crypto1 session, the backdoor
+            # frames have to go out in plain: select it again by UID
+            if clf.sense(
+                nfc.clf.RemoteTarget('106A', sel_req=target.sdd_res)
+            ) is None:
+                raise CardError("card not responding after sector read")
+
             print("Testing write capability...\n")
-            diagnose_write_capability()
+            diagnose_write_capability(clf, target)
             return True
 
-        elif "Permission denied" in output or \
-             "Access violation" in output or \
-             "Authentication failed" in output:
+        else:
             print("✗ Authentication failed")
             print("→ Card has restricted access")
             print("→ UID cannot be rewritten\n")
             return False
 
-        else:
-            print("⚠ Read attempt produced output:")
-            print(output)
-            return None
-
-    except FileNotFoundError:
-        print("✗ nfc-mfclassic not installed")
-        print("Install: sudo apt-get install nfc-tools")
-        return None
-
-    except subprocess.TimeoutExpired:
+    except (nfc.clf.pn53x.Chipset.Error, CardError):
+        _forget_tag()
         print("✗ Timeout - card not responding")
         return False
+    except IOError as e:
+        _reader_lost()
+        print(f"✗ Reader error: {e}")
+        return None
     except Exception as e:
         print(f"Error: {e}")
+        _debug_trace()
         return None
 
 
-def diagnose_write_capability():
-    """Test if card supports UID write"""
-    print("Card vendor detection:")
-    print("  Chinese clones → nfc-mfsetuid will work")
-    print("  Genuine/commercial → use alternative method\n")
+def diagnose_write_capability(clf, target=None):
+    """Test if card supports UID write, target skips the tag lookup"""
+    _write(_VENDOR_HEADER)
 
     try:
-        # Try nfc-mfsetuid with a dummy value to see if it detects the card
-        result = subprocess.run(
-            ['nfc-mfsetuid', '00000000'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
+        if target is None:
+            target, _ = _get_tag(clf)
 
-        output = result.stdout + result.stderr
-
-        if "No suitable card found" in output:
-            print("Result: Card not detected by nfc-mfsetuid")
-            print("→ May not be compatible with nfc-mfsetuid")
+        if target is None:
+            print("Result: Card no longer on the reader")
             return False
 
-        elif "Setting UID" in output or "Successfully" in output:
-            print("Result: Card compatible with nfc-mfsetuid")
+        # Only unlock the backdoor, never write, so the probe is read-only
+        if _is_gen1a(clf, target):
+            print("Result: Card answers the gen1a backdoor")
             print("→ Card is a Chinese clone (UID writable)")
             return True
 
-        else:
-            print("Result: Uncertain compatibility")
-            print("Output:", output)
-            return None
+        uid = target.sdd_res
+        if len(uid) == 7 and uid[0] == 0x04:
+            # Double size UIDs start with the manufacturer code, NXP is 04
+            print("Result: Card has an NXP manufacturer byte")
+            print("→ Card is genuine (UID not writable)")
+            return False
+
+        print("Result: No gen1a backdoor")
+        print("→ May be a gen2 clone (block 0 writable after auth)")
+        print("→ Option 4 only writes gen1a clones")
+        return None
 
-    except subprocess.TimeoutExpired:
-        print("Timeout during write test")
+    except (nfc.clf.pn53x.Chipset.Error, CardError):
+        _forget_tag()
+        print("Timeout - card not responding")
         return False
+    except IOError as e:
+        _reader_lost()
+        print(f"Reader error: {e}")
+        return None
     except Exception as e:
         print(f"Error: {e}")
+        _debug_trace()
         return None
 
 
-def write_nfc_tag(serial_number):
-    """Write serial number to NFC tag using nfc-mfsetuid"""
+def write_nfc_tag(clf, uid):
+    """Write 4 byte UID to a Chinese clone MIFARE Classic card"""
+    serial_number = uid.hex().upper()
     print(f"\nPreparing to write: '{serial_number}'")
     print("Place NFC tag on reader...\n")
 
     try:
-        result = subprocess.run(
-            ['nfc-mfsetuid', serial_number],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
+        target, _ = _get_tag(clf)
 
-        print(result.stdout)
+        if target is None:
+            print("✗ Timeout - no tag detected")
+            return False
 
-        if result.returncode == 0 or "Setting UID" in result.stdout:
+        if target.sel_res[0] not in MIFARE_CLASSIC_SAK:
+            print("✗ Failed to write tag\n")
+            print("→ This is not a MIFARE Classic card")
+            print("→ UID writes only work with clones")
+            return False
+
+        if _magic_write_block0(clf, uid):
+            # The card now answers with a different UID
+            _forget_tag()
             print(f"✓ Successfully wrote: '{serial_number}'")
             return True
         else:
-            error_text = result.stderr + result.stdout
-
             print("✗ Failed to write tag\n")
+            print("→ This is NOT a Chinese clone card")
+            print("→ UID writes only work with clones")
+            return False
 
-            if "No suitable card found" in error_text:
-                print("→ Card not detected or not compatible")
-                print("→ This card may not support UID rewriting")
-            elif "Not a special card" in error_text or \
-                 "not special" in error_text.lower():
-                print("→ This is NOT a Chinese clone card")
-                print("→ nfc-mfsetuid only works with clones")
-            elif "Permission denied" in error_text or \
-                 "not allowed" in error_text.lower():
-                print("→ Write permission denied")
-            else:
-                print("Error output:", error_text)
+    except (nfc.clf.pn53x.Chipset.Error, CardError) as e:
+        _forget_tag()
+        print("✗ Failed to write tag\n")
+        print(f"→ Card stopped responding ({e})")
+        return False
+    except IOError as e:
+        _reader_lost()
+        print(f"✗ Reader error: {e}")
+        return False
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        _debug_trace()
+        return False
 
-            return False
 
-    except FileNotFoundError:
-        print("✗ nfc-mfsetuid not found")
-        print("Install: sudo apt-get install nfc-tools")
+def _write_text(tag, text):
+    """Write text as a single NDEF text record to an activated tag"""
+    if tag.ndef is None:
+        print("✗ Failed to write tag\n")
+        print("→ Tag is not NDEF formatted")
+        return False
+
+    if not tag.ndef.is_writeable:
+        print("✗ Failed to write tag\n")
+        print("→ Tag is write protected")
         return False
-    except subprocess.TimeoutExpired:
-        print("✗ Timeout - no tag detected")
+
+    try:
+        tag.ndef.records = [ndef.TextRecord(text, language='en')]
+    except ValueError:
+        print("✗ Failed to write tag\n")
+        print(f"→ Text too long for tag ({tag.ndef.capacity} bytes)")
+        return False
+    except nfc.tag.TagCommandError as e:
+        print("✗ Failed to write tag\n")
+        print(f"→ Tag stopped responding, was it removed? ({e})")
+        return False
+
+    print(f"✓ Successfully wrote: '{text}'")
+    return True
+
+
+def write_ndef_text(clf, text):
+    """Write text to an NDEF formatted tag (NTAG / Ultralight)"""
+    print(f"\nPreparing to write text: '{text}'")
+    print("Place NFC tag on reader...\n")
+
+    try:
+        target, tag = _get_tag(clf)
+
+        if target is None:
+            print("✗ Timeout - no tag detected")
+            return False
+
+        if tag is None:
+            print("✗ Failed to write tag\n")
+            print("→ Tag is not NDEF formatted")
+            print("→ MIFARE Classic cards: use option 4 for the UID")
+            return False
+
+        return _write_text(tag, text)
+
+    except IOError as e:
+        _reader_lost()
+        print(f"✗ Reader error: {e}")
         return False
     except Exception as e:
         print(f"✗ Error: {e}")
+        _debug_trace()
         return False
 
 
-def list_devices():
-    """List available NFC readers"""
-    print("Available NFC Devices:")
-    print("=" * 50 + "\n")
+def write_batch(clf, texts):
+    """Write each text to its own tag, swapping tags in between"""
+    print(f"\nBatch writing {len(texts)} tags (Ctrl-C to stop)")
+
+    skipped = set()
+
+    def on_discover(target):
+        # Type 1 (Topaz) has no UID here, report it once until it's removed
+        if target.sel_res is None:
+            if 'topaz' not in skipped:
+                skipped.add('topaz')
+                print("✗ Type 1 (Topaz) tag, not supported - remove it")
+            return False
+        # nfcpy can't activate MIFARE Classic, tell the user once per card
+        if target.sel_res[0] in MIFARE_CLASSIC_SAK:
+            if bytes(target.sdd_res) not in skipped:
+                skipped.add(bytes(target.sdd_res))
+                print("✗ MIFARE Classic card, not NDEF writable - remove it")
+            return False
+        return True
+
+    def on_release(tag):
+        skipped.clear()
+        return True
+
+    written = 0
+    try:
+        for i, text in enumerate(texts, 1):
+            result = {}
+
+            def on_connect(tag):
+                result['ok'] = _write_text(tag, text)
+                print("→ Remove tag")
+                return True
+
+            prompt = f"\n[{i}/{len(texts)}] Place tag for: '{text}'"
+            print(prompt)
+            while not result.get('ok') and not _cancel.is_set():
+                if result:
+                    # The last write failed, ask for the tag again
+                    print(prompt)
+                    result.clear()
+                connected = clf.connect(
+                    rdwr={
+                        'targets': ['106A'],
+                        'on-discover': on_discover,
+                        'on-connect': on_connect,
+                        'on-release': on_release,
+                        # One sense per call, so a cancel is seen
+                        # within a round instead of after 30
+                        'iterations': 1,
+                        'interval': 0.1,
+                    },
+                    terminate=_cancel.is_set
+                )
+                if connected is False:
+                    raise IOError("reader stopped responding")
+
+            # A write that went through counts even if the batch was
+            # cancelled while waiting for the tag to be removed
+            if result.get('ok'):
+                written += 1
+            if _cancel.is_set():
+                break
+
+    except IOError as e:
+        _reader_lost()
+        print(f"✗ Reader error: {e}")
+    finally:
+        # Every tag in the batch has been swapped out
+        _forget_tag()
+
+    print(f"\n✓ Wrote {written} of {len(texts)} tags")
+    return written
+
+
+def list_devices(clf=None):
+    """List available NFC readers, marking clf's if one is open"""
+    _write(_LIST_HEADER)
 
     try:
-        result = subprocess.run(
-            ['nfc-list'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
+        readers = _enumerate_devices()
+
+        if not readers:
+            print("No devices found")
 
-        print(result.stdout if result.stdout else "No devices found")
+        for path, vid, pid, driver in readers:
+            line = f"  {path}  {vid:04x}:{pid:04x}  ({driver})"
+            if clf is not None and clf.device is not None \
+                    and clf.device.path == path:
+                line += f"  <- {clf.device.vendor_name} " \
+                        f"{clf.device.product_name}"
+            print(line)
 
-    except FileNotFoundError:
-        print("nfc-list not installed")
     except Exception as e:
         print(f"Error: {e}")
+        _debug_trace()
 
 
-def main():
-    """Main menu"""
-    print("\n" + "=" * 50)
-    print("NFC Tag Manager - ACR122U")
-    print("=" * 50)
-    print("\nIMPORTANT:")
-    print("• Option 4 only works with CHINESE CLONE Mifare 1K cards")
-    print("=" * 50 + "\n")
+def _get_clf():
+    """Return the reader, opening it on first use"""
+    global _clf
+    if _clf is None:
+        # One bus scan for the session, list_devices prints the same list
+        readers = _enumerate_devices()
+        _clf = nfc.ContactlessFrontend(readers[0][0] if readers else 'usb')
+    return _clf
+
 
-    list_devices()
+@atexit.register
+def _close_clf():
+    """Release the reader if an NFC action opened it"""
+    if _clf is not None:
+        _clf.close()
 
+
+def _worker(cmd_q, result_q, done_w):
+    """Run queued NFC operations one at a time, a byte to done_w per job"""
     while True:
-        print("\nOptions:")
-        print("  1. Read NFC tag")
-        print("  2. Identify card type")
-        print("  3. Diagnose card (UID write capability)")
-        print("  4. Write serial number to tag (UID - clones only)")
-        print("  5. Exit")
+        job = cmd_q.get()
+        if job is None:
+            break
 
-        choice = input("\nSelect option (1-5): ").strip()
+        fn, args = job
+        result = None
+        try:
+            with _clf_lock:
+                try:
+                    clf = _get_clf()
+                except Exception as e:
+                    _enumerate_devices.cache_clear()
+                    print(f"✗ Could not open NFC reader: {e}")
+                    _debug_trace()
+                    continue
+
+                result = fn(clf, *args)
+        except Exception as e:
+            print(f"✗ Error: {e}")
+            _debug_trace()
+        finally:
+            # _run waits for this byte, send it whatever happened
+            result_q.put(result)
+            os.write(done_w, b'\x00')
+
+
+def _run(cmd_q, result_q, done_r, fn, *args):
+    """Queue an NFC operation and wait for its result
+
+    Enter or Ctrl-C cancels the operation.
+    """
+    _cancel.clear()
+    cmd_q.put((fn, args))
+
+    with selectors.DefaultSelector() as sel:
+        sel.register(done_r, selectors.EVENT_READ)
+        # Only a terminal, piped input holds the next menu choices
+        if sys.stdin.isatty():
+            sel.register(sys.stdin, selectors.EVENT_READ)
+
+        while True:
+            try:
+                for key, _ in sel.select():
+                    if key.fileobj is sys.stdin:
+                        sys.stdin.readline()
+                        sel.unregister(sys.stdin)
+                        print("✗ Cancelled")
+                        _cancel.set()
+                    else:
+                        os.read(done_r, 1)
+                        return result_q.get()
+            except KeyboardInterrupt:
+                print("\n✗ Cancelled")
+                _cancel.set()
+
+
+def _menu_list_devices(run):
+    """Option 0: list readers, without opening one"""
+    # Listing is most useful when the reader can't be opened, so it
+    # doesn't go through the worker, which opens it first
+    print()
+    with _clf_lock:
+        if _clf is None:
+            # Nothing opened from the cached list yet, scan again in
+            # case a reader was plugged in since
+            _enumerate_devices.cache_clear()
+        list_devices(_clf)
+
+
+def _action(fn):
+    """Menu action that runs an NFC operation needing no input"""
+    def action(run):
+        print()
+        run(fn)
+    return action
+
+
+def _confirm(prompt):
+    """Ask y/n on a terminal, piped command scripts are not asked"""
+    if not sys.stdin.isatty():
+        return True
+    return input(prompt).strip().lower() == 'y'
+
+
+def _menu_write_uid(run):
+    """Option 4: write a UID typed as hex to a clone card"""
+    serial = input("\nEnter serial number (hex, e.g. C2B44B41): ").strip()
+
+    if not serial:
+        print("✗ Serial number cannot be empty")
+        return
+
+    # fromhex also takes the spaced form nfc-poll prints
+    try:
+        uid = bytes.fromhex(serial)
+    except ValueError:
+        print("✗ Invalid hex format")
+        return
 
-        if choice == '1':
-            print()
-            read_nfc_tag()
+    if len(uid) != 4:
+        print("✗ Serial must be exactly 8 hex characters")
+        return
 
-        elif choice == '2':
-            print()
-            identify_card_type()
+    if _confirm(f"Write UID '{uid.hex().upper()}' to tag? (y/n): "):
+        run(write_nfc_tag, uid)
+    else:
+        print("Cancelled")
 
-        elif choice == '3':
-            print()
-            diagnose_card()
 
-        elif choice == '4':
-            serial = input(
-                "\nEnter serial number (hex, e.g. C2B44B41): "
-            ).strip()
+def _menu_write_text(run):
+    """Option 5: write one NDEF text record"""
+    text = input("\nEnter text to write: ").strip()
 
-            if not serial:
-                print("✗ Serial number cannot be empty")
-                continue
+    if not text:
+        print("✗ Text cannot be empty")
+        return
 
-            if len(serial) != 8:
-                print("✗ Serial must be exactly 8 hex characters")
-                continue
+    run(write_ndef_text, text)
+
+
+def _menu_write_batch(run):
+    """Option 6: write NDEF text records from a file, one tag per line"""
+    path = input("\nFile with one text per line: ").strip()
+
+    try:
+        with open(path) as f:
+            texts = [line.strip() for line in f if line.strip()]
+    except OSError as e:
+        print(f"✗ Could not read file: {e}")
+        return
+
+    if not texts:
+        print("✗ File is empty")
+        return
+
+    run(write_batch, texts)
+
+
+# Menu choice -> action taking the NFC job runner, '7' exits
+_MENU_ACTIONS = {
+    '0': _menu_list_devices,
+    '1': _action(read_nfc_tag),
+    '2': _action(identify_card_type),
+    '3': _action(diagnose_card),
+    '4': _menu_write_uid,
+    '5': _menu_write_text,
+    '6': _menu_write_batch,
+}
+
+
+def main():
+    """Main menu"""
+    if dependencies_missing():
+        sys.exit(1)
+
+    _write(_HEADER)
+
+    cmd_q = queue.Queue()
+    result_q = queue.Queue()
+    # The worker writes a byte here per finished job, so the menu thread
+    # can wait on it and stdin in one select
+    done_r, done_w = os.pipe()
+    worker = threading.Thread(
+        target=_worker,
+        args=(cmd_q, result_q, done_w),
+        daemon=True
+    )
+    worker.start()
+    run = functools.partial(_run, cmd_q, result_q, done_r)
+
+    try:
+        while True:
+            _write(_MENU)
 
             try:
-                int(serial, 16)
-            except ValueError:
-                print("✗ Invalid hex format")
-                continue
-
-            confirm = (
-                input(
-                    f"Write UID '{serial}' to tag? (y/n): "
-                )
-                .strip()
-                .lower()
-            )
-            if confirm == 'y':
-                write_nfc_tag(serial)
-            else:
-                print("Cancelled")
+                choice = input("\nSelect option (0-7): ").strip()
+                action = _MENU_ACTIONS.get(choice)
+
+                if action is not None:
+                    action(run)
+                    continue
+            except EOFError:
+                # End of a piped command script, also inside an
+                # option's own prompts
+                print()
+                choice = '7'
+
+            if choice == '7':
+                print("Exiting...")
+                break
 
-        elif choice == '5':
-            print("Exiting...")
-            break
+            else:
+                print("✗ Invalid option")
 
-        else:
-            print("✗ Invalid option")
+    finally:
+        cmd_q.put(None)
+        worker.join()
+        os.close(done_r)
+        os.close(done_w)
 
 
 if __name__ == "__main__":
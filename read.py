@@ -1,65 +1,33 @@
-import subprocess
 import sys
 
 
-def read_nfc_tag():
-    """Read NFC tag using libnfc (nfc-poll)"""
-    print("NFC Tag Reader - ACR122U")
-    print("=" * 50)
-    print("Waiting for NFC tag...\n")
+def main():
+    """List NFC readers, then read one tag"""
+    # nfcpy is only loaded when run as a script, `import read` stays cheap
+    import multitool
+    if multitool.dependencies_missing():
+        sys.exit(1)
 
-    try:
-        result = subprocess.run(
-            ['nfc-poll'],
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
-
-        if result.stdout:
-            print(result.stdout)
-
-        if "ISO/IEC 14443A" in result.stdout:
-            print("✓ Tag read successfully!")
-            return True
-        else:
-            print("✗ No tag detected")
-            return False
-
-    except FileNotFoundError:
-        print("✗ nfc-poll not installed")
-        print("Install: sudo apt-get install libnfc-bin")
-        return False
-    except subprocess.TimeoutExpired:
-        print("✗ Timeout - no tag detected")
-        return False
-    except Exception as e:
-        print(f"✗ Error: {e}")
-        return False
+    import nfc
 
-
-def list_devices():
-    """List available NFC readers"""
-    print("Available NFC Devices:")
-    print("=" * 50 + "\n")
+    # Listed before opening, so a missing or busy reader still shows up
+    multitool.list_devices()
+    print("\n")
 
     try:
-        result = subprocess.run(
-            ['nfc-list'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
+        clf = nfc.ContactlessFrontend('usb')
+    except IOError as e:
+        print(f"✗ Could not open NFC reader: {e}")
+        return
 
-        print(result.stdout if result.stdout else "No devices found")
-
-    except FileNotFoundError:
-        print("nfc-list not installed")
-    except Exception as e:
-        print(f"Error: {e}")
+    # Ctrl-C lands in the poll's short sense or pause, well within a
+    # second, and the with block releases the reader
+    with clf:
+        try:
+            multitool.read_nfc_tag(clf, timeout=60)
+        except KeyboardInterrupt:
+            print("\n✗ Cancelled")
 
 
 if __name__ == "__main__":
-    list_devices()
-    print("\n")
-    read_nfc_tag()
\ No newline at end of file
+    main()